@@ -1,8 +1,8 @@
-import json
 import logging
 
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.core import HomeAssistant
+from homeassistant.helpers.json import json_bytes
 from homeassistant.helpers.typing import ConfigType
 
 from .const import DOMAIN
@@ -12,7 +12,8 @@ logger = logging.getLogger(__name__)
 
 
 async def async_setup(hass: HomeAssistant, config: ConfigType) -> bool:
-    logger.debug(f"Oh My Light Installed!, Current config: {json.dumps(config[DOMAIN], ensure_ascii=False)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Oh My Light Installed!, Current config: %s", json_bytes(config[DOMAIN]).decode())
 
     hass.data.setdefault(DOMAIN, {})
     # 初始化coordinator manager
@@ -21,16 +22,18 @@ async def async_setup(hass: HomeAssistant, config: ConfigType) -> bool:
 
 
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
-    logger.debug(f"<{entry.title}> Setting up entry, Config: {json.dumps(entry.as_dict(), ensure_ascii=False)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("<%s> Setting up entry, Config: %s", entry.title, json_bytes(entry.as_dict()).decode())
 
     coordinator_manager = hass.data[DOMAIN]["coordinator_manager"]
-    await coordinator_manager.async_setup_coordinator(entry.title, entry.data["func_name"], entry)
+    await coordinator_manager.async_setup_coordinator(entry.entry_id, entry.data["func_name"], entry)
     return True
 
 
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
-    logger.debug(f"<{entry.title}> Unloading entry, Config: {json.dumps(entry.as_dict(), ensure_ascii=False)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("<%s> Unloading entry, Config: %s", entry.title, json_bytes(entry.as_dict()).decode())
 
     coordinator_manager = hass.data[DOMAIN]["coordinator_manager"]
-    await coordinator_manager.async_unload_coordinator(entry.title)
+    await coordinator_manager.async_unload_coordinator(entry.entry_id)
     return True
@@ -1,6 +1,7 @@
 import logging
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from collections.abc import Iterable
+from dataclasses import dataclass, field
 from typing import Any
 
 import voluptuous as vol
@@ -11,31 +12,63 @@ from homeassistant.helpers import selector
 
 from .const import DOMAIN, FUNC_NAME_LIGHT_EVENT_BIND, FUNC_NAME_LIGHT_SWITCH_BIND, FUNC_NAME_LIGHT_SYNC
 from .utils import (
+    async_get_listened_light_index,
     async_parse_light,
     async_whether_light_listen_by_other,
 )
 
 logger = logging.getLogger(__name__)
 
+# 表单中使用的实体选择器，均为不可变对象，只构建一次
+LIGHT_MULTI_SELECTOR = selector.EntitySelector(
+    selector.EntitySelectorConfig(domain="light", multiple=True),
+)
+SWITCH_MULTI_SELECTOR = selector.EntitySelector(
+    selector.EntitySelectorConfig(domain=["switch", "binary_sensor"], multiple=True),
+)
+EVENT_MULTI_SELECTOR = selector.EntitySelector(
+    selector.EntitySelectorConfig(domain="event", multiple=True),
+)
 
-@dataclass
+# 未填写任何数据时展示的表单，与用户输入无关，只构建一次
+LIGHT_SYNC_SCHEMA = vol.Schema(
+    {
+        vol.Required("light_sync_entity_ids"): LIGHT_MULTI_SELECTOR,
+    }
+)
+
+LIGHT_SWITCH_BIND_SCHEMA = vol.Schema(
+    {
+        vol.Required("switch_entity_ids"): SWITCH_MULTI_SELECTOR,
+        vol.Required("light_entity_ids"): LIGHT_MULTI_SELECTOR,
+    }
+)
+
+LIGHT_EVENT_BIND_SCHEMA = vol.Schema(
+    {
+        vol.Required("event_entity_ids"): EVENT_MULTI_SELECTOR,
+        vol.Required("light_entity_ids"): LIGHT_MULTI_SELECTOR,
+    }
+)
+
+
+@dataclass(slots=True, frozen=True)
 class UserInputParseResult:
     """
     包装user_input的解析结果
     """
 
     create_entry: bool
-    data_or_schema: dict[str, Any]
-    errors: dict[str, str]
-    description_placeholders: dict[str, str] = None
+    data_or_schema: dict[str, Any] | vol.Schema
+    errors: dict[str, str] = field(default_factory=dict)
+    description_placeholders: dict[str, str] = field(default_factory=dict)
+
 
-    def as_dict(self) -> dict[str, Any]:
-        return {
-            "create_entry": self.create_entry,
-            "data_or_schema": self.data_or_schema,
-            "errors": self.errors,
-            "description_placeholders": self.description_placeholders or {},
-        }
+def _make_entry_data(func_name: str, /, **func_data: Any) -> dict[str, Any]:
+    """
+    构建config entry保存的数据
+    """
+    return {"func_name": func_name, "func_data": func_data}
 
 
 class OhMyLightBaseFlowManager(ABC):
@@ -43,10 +76,18 @@ class OhMyLightBaseFlowManager(ABC):
     基础类，定义了所有配置流程的通用方法
     """
 
-    def __init__(self, name: str, func_name: str, hass: HomeAssistant) -> None:
+    def __init__(
+        self,
+        name: str,
+        func_name: str,
+        hass: HomeAssistant,
+        entry_id: str | None = None,
+    ) -> None:
         self._name = name
         self.func_name = func_name
         self.hass = hass
+        # 修改配置时配置项的id，新建配置项时为None
+        self._entry_id = entry_id
 
     @abstractmethod
     async def async_parse_user_input(
@@ -59,6 +100,27 @@ class OhMyLightBaseFlowManager(ABC):
 
 
 class LightSyncFlowManager(OhMyLightBaseFlowManager):
+    def __init__(
+        self,
+        name: str,
+        func_name: str,
+        hass: HomeAssistant,
+        entry_id: str | None = None,
+    ) -> None:
+        super().__init__(name, func_name, hass, entry_id)
+        # 缓存本次配置流程中已解析过的灯实体，用户修正输入重新提交时无需重复解析
+        self._parsed_light_cache: dict[tuple[str, ...], tuple[set[str], dict[str, set[str]]]] = {}
+
+    @callback
+    def _async_parse_light(self, light_entity_ids: Iterable[str]) -> tuple[set[str], dict[str, set[str]]]:
+        """
+        解析灯实体列表，同一流程内相同的输入只解析一次
+        """
+        cache_key = tuple(sorted(light_entity_ids))
+        if (parsed := self._parsed_light_cache.get(cache_key)) is None:
+            parsed = self._parsed_light_cache[cache_key] = async_parse_light(self.hass, light_entity_ids)
+        return parsed
+
     async def async_parse_user_input(
         self, user_input: dict[str, Any], default_data: dict[str, Any] = None
     ) -> UserInputParseResult:
@@ -72,12 +134,7 @@ class LightSyncFlowManager(OhMyLightBaseFlowManager):
             light_sync_entity_ids = func_data.get("light_sync_entity_ids", [])
             schema = vol.Schema(
                 {
-                    vol.Required(
-                        "light_sync_entity_ids",
-                        default=light_sync_entity_ids,
-                    ): selector.EntitySelector(
-                        selector.EntitySelectorConfig(domain="light", multiple=True),
-                    ),
+                    vol.Required("light_sync_entity_ids", default=light_sync_entity_ids): LIGHT_MULTI_SELECTOR,
                 }
             )
             return UserInputParseResult(
@@ -87,61 +144,62 @@ class LightSyncFlowManager(OhMyLightBaseFlowManager):
             )
 
         if user_input and (light_sync_entity_ids := user_input.get("light_sync_entity_ids")):
-            # 判断是否有灯实体id在其他配置项中被使用，如果有使用，则提示并让用户修改输入
-            (
-                normal_light_entity_ids,
-                light_of_group_entity_ids,
-            ) = await async_parse_light(self.hass, light_sync_entity_ids)
-
-            (
-                existing_light_entity_ids,
-                existing_config_entry,
-            ) = await async_whether_light_listen_by_other(
-                self.hass,
-                self._name,
-                self.func_name,
-                normal_light_entity_ids.union(*light_of_group_entity_ids.values()),
-            )
-            if existing_light_entity_ids:
-                schema = vol.Schema(
-                    {
-                        vol.Required("light_sync_entity_ids", default=light_sync_entity_ids): selector.EntitySelector(
-                            selector.EntitySelectorConfig(domain="light", multiple=True),
-                        ),
-                    }
-                )
-                return UserInputParseResult(
-                    create_entry=False,
-                    data_or_schema=schema,
-                    errors={
-                        "base": "light_entity_ids_in_other_entries",
-                    },
-                    description_placeholders={
-                        "existing_light_entity_ids": ",".join(existing_light_entity_ids),
-                        "existing_config_entry_id": existing_config_entry.title,
-                    },
+            # 本配置项的协调器已占用的灯实体不会与其他配置项冲突，只需检查其余的灯实体
+            # 配置项因冲突未能开始监听时没有占用任何灯实体，所有灯实体都会被检查
+            new_light_entity_ids = set(light_sync_entity_ids)
+            if self._entry_id:
+                listened_light_index = async_get_listened_light_index(self.hass, self.func_name)
+                new_light_entity_ids = {
+                    light_entity_id
+                    for light_entity_id in new_light_entity_ids
+                    if (config_entry := listened_light_index.get(light_entity_id)) is None
+                    or config_entry.entry_id != self._entry_id
+                }
+
+            if new_light_entity_ids:
+                # 判断是否有灯实体id在其他配置项中被使用，如果有使用，则提示并让用户修改输入
+                (
+                    normal_light_entity_ids,
+                    light_of_group_entity_ids,
+                ) = self._async_parse_light(new_light_entity_ids)
+
+                (
+                    existing_light_entity_ids,
+                    existing_config_entry,
+                ) = async_whether_light_listen_by_other(
+                    self.hass,
+                    self._entry_id,
+                    self.func_name,
+                    normal_light_entity_ids.union(*light_of_group_entity_ids.values()),
                 )
+                if existing_light_entity_ids:
+                    schema = vol.Schema(
+                        {
+                            vol.Required("light_sync_entity_ids", default=light_sync_entity_ids): LIGHT_MULTI_SELECTOR,
+                        }
+                    )
+                    return UserInputParseResult(
+                        create_entry=False,
+                        data_or_schema=schema,
+                        errors={
+                            "base": "light_entity_ids_in_other_entries",
+                        },
+                        description_placeholders={
+                            "existing_light_entity_ids": ",".join(existing_light_entity_ids),
+                            "existing_config_entry_id": existing_config_entry.title,
+                        },
+                    )
 
             return UserInputParseResult(
                 create_entry=True,
-                data_or_schema={
-                    "func_name": self.func_name,
-                    "func_data": {"light_sync_entity_ids": list(light_sync_entity_ids)},
-                },
+                data_or_schema=_make_entry_data(self.func_name, light_sync_entity_ids=sorted(light_sync_entity_ids)),
                 errors={},
             )
 
         # 选择多个灯
-        schema = vol.Schema(
-            {
-                vol.Required("light_sync_entity_ids"): selector.EntitySelector(
-                    selector.EntitySelectorConfig(domain="light", multiple=True),
-                ),
-            }
-        )
         return UserInputParseResult(
             create_entry=False,
-            data_or_schema=schema,
+            data_or_schema=LIGHT_SYNC_SCHEMA,
             errors={},
         )
 
@@ -157,12 +215,8 @@ class LightSwitchBindFlowManager(OhMyLightBaseFlowManager):
             light_entity_ids = func_data.get("light_entity_ids", [])
             schema = vol.Schema(
                 {
-                    vol.Required("switch_entity_ids", default=switch_entity_ids): selector.EntitySelector(
-                        selector.EntitySelectorConfig(domain=["switch", "binary_sensor"], multiple=True),
-                    ),
-                    vol.Required("light_entity_ids", default=light_entity_ids): selector.EntitySelector(
-                        selector.EntitySelectorConfig(domain="light", multiple=True),
-                    ),
+                    vol.Required("switch_entity_ids", default=switch_entity_ids): SWITCH_MULTI_SELECTOR,
+                    vol.Required("light_entity_ids", default=light_entity_ids): LIGHT_MULTI_SELECTOR,
                 }
             )
             return UserInputParseResult(
@@ -178,30 +232,18 @@ class LightSwitchBindFlowManager(OhMyLightBaseFlowManager):
         ):
             return UserInputParseResult(
                 create_entry=True,
-                data_or_schema={
-                    "func_name": self.func_name,
-                    "func_data": {
-                        "switch_entity_ids": switch_entity_ids,
-                        "light_entity_ids": light_entity_ids,
-                    },
-                },
+                data_or_schema=_make_entry_data(
+                    self.func_name,
+                    switch_entity_ids=switch_entity_ids,
+                    light_entity_ids=light_entity_ids,
+                ),
                 errors={},
             )
 
         # 选择多个开关和多个灯
-        schema = vol.Schema(
-            {
-                vol.Required("switch_entity_ids"): selector.EntitySelector(
-                    selector.EntitySelectorConfig(domain=["switch", "binary_sensor"], multiple=True),
-                ),
-                vol.Required("light_entity_ids"): selector.EntitySelector(
-                    selector.EntitySelectorConfig(domain="light", multiple=True),
-                ),
-            }
-        )
         return UserInputParseResult(
             create_entry=False,
-            data_or_schema=schema,
+            data_or_schema=LIGHT_SWITCH_BIND_SCHEMA,
             errors={},
         )
 
@@ -217,12 +259,8 @@ class LightEventBindFlowManager(OhMyLightBaseFlowManager):
             light_entity_ids = func_data.get("light_entity_ids", [])
             schema = vol.Schema(
                 {
-                    vol.Required("event_entity_ids", default=event_entity_ids): selector.EntitySelector(
-                        selector.EntitySelectorConfig(domain="event", multiple=True),
-                    ),
-                    vol.Required("light_entity_ids", default=light_entity_ids): selector.EntitySelector(
-                        selector.EntitySelectorConfig(domain="light", multiple=True),
-                    ),
+                    vol.Required("event_entity_ids", default=event_entity_ids): EVENT_MULTI_SELECTOR,
+                    vol.Required("light_entity_ids", default=light_entity_ids): LIGHT_MULTI_SELECTOR,
                 }
             )
             return UserInputParseResult(
@@ -238,30 +276,18 @@ class LightEventBindFlowManager(OhMyLightBaseFlowManager):
         ):
             return UserInputParseResult(
                 create_entry=True,
-                data_or_schema={
-                    "func_name": self.func_name,
-                    "func_data": {
-                        "event_entity_ids": event_entity_ids,
-                        "light_entity_ids": light_entity_ids,
-                    },
-                },
+                data_or_schema=_make_entry_data(
+                    self.func_name,
+                    event_entity_ids=event_entity_ids,
+                    light_entity_ids=light_entity_ids,
+                ),
                 errors={},
             )
 
         # 选择多个事件和多个灯
-        schema = vol.Schema(
-            {
-                vol.Required("event_entity_ids"): selector.EntitySelector(
-                    selector.EntitySelectorConfig(domain="event", multiple=True),
-                ),
-                vol.Required("light_entity_ids"): selector.EntitySelector(
-                    selector.EntitySelectorConfig(domain="light", multiple=True),
-                ),
-            }
-        )
         return UserInputParseResult(
             create_entry=False,
-            data_or_schema=schema,
+            data_or_schema=LIGHT_EVENT_BIND_SCHEMA,
             errors={},
         )
 
@@ -272,6 +298,20 @@ FLOW_CLASS_MAP: dict[str, type[OhMyLightBaseFlowManager]] = {
     FUNC_NAME_LIGHT_EVENT_BIND: LightEventBindFlowManager,
 }
 
+FUNC_NAME_OPTIONS: tuple[str, ...] = tuple(FLOW_CLASS_MAP)
+
+USER_STEP_SCHEMA = vol.Schema(
+    {
+        vol.Optional("name", default="Rule1"): str,
+        vol.Required("func_name", default=FUNC_NAME_LIGHT_SYNC): selector.SelectSelector(
+            selector.SelectSelectorConfig(
+                translation_key="func_name",
+                options=list(FUNC_NAME_OPTIONS),
+            ),
+        ),
+    }
+)
+
 
 class OhMyLightConfigFlow(ConfigFlow, domain=DOMAIN):
     VERSION = 1
@@ -281,6 +321,7 @@ class OhMyLightConfigFlow(ConfigFlow, domain=DOMAIN):
         super().__init__()
         self._name = None
         self._func_name = None
+        self._func_flow: OhMyLightBaseFlowManager | None = None
 
     @staticmethod
     @callback
@@ -288,40 +329,44 @@ class OhMyLightConfigFlow(ConfigFlow, domain=DOMAIN):
         return OhMyLightOptionsFlow()
 
     async def async_step_user(self, user_input: dict[str, Any] | None = None) -> FlowResult:
-        logger.debug(f"<{self._name}> user_input: {user_input}")
+        logger.debug("<%s> user_input: %s", self._name, user_input)
         if user_input:
             self._name = self._name or user_input.get("name")
             self._func_name = self._func_name or user_input.get("func_name")
 
         if not self._name or not self._func_name:
-            schema = vol.Schema(
-                {
-                    vol.Optional("name", default="Rule1"): str,
-                    vol.Required("func_name", default=FUNC_NAME_LIGHT_SYNC): selector.SelectSelector(
-                        selector.SelectSelectorConfig(
-                            translation_key="func_name",
-                            options=list[str](FLOW_CLASS_MAP.keys()),
-                        ),
-                    ),
-                }
-            )
             return self.async_show_form(
                 step_id="user",
-                data_schema=schema,
+                data_schema=USER_STEP_SCHEMA,
             )
 
         await self.async_set_unique_id(self._name)
         self._abort_if_unique_id_configured()
 
-        setattr(self, f"async_step_{self._func_name}", self.async_step_user)
+        return await self._async_step_func(None)
+
+    async def async_step_light_sync(self, user_input: dict[str, Any] | None = None) -> FlowResult:
+        return await self._async_step_func(user_input)
 
-        flow_class = FLOW_CLASS_MAP.get(self._func_name)
-        if not flow_class:
-            return self.async_abort(reason="unknown_func_name")
-        func_flow = flow_class(self._name, self._func_name, self.hass)
+    async def async_step_light_switch_bind(self, user_input: dict[str, Any] | None = None) -> FlowResult:
+        return await self._async_step_func(user_input)
 
-        flow_result = await func_flow.async_parse_user_input(user_input)
-        logger.debug(f"<{self._name}> async_step_{self._func_name}: {flow_result.as_dict()}")
+    async def async_step_light_event_bind(self, user_input: dict[str, Any] | None = None) -> FlowResult:
+        return await self._async_step_func(user_input)
+
+    async def _async_step_func(self, user_input: dict[str, Any] | None) -> FlowResult:
+        """
+        各功能配置步骤的通用处理，交由对应的func_flow解析用户输入
+        """
+        # 同一流程的多次提交复用同一个func_flow，以复用其中的解析缓存
+        if self._func_flow is None:
+            flow_class = FLOW_CLASS_MAP.get(self._func_name)
+            if not flow_class:
+                return self.async_abort(reason="unknown_func_name")
+            self._func_flow = flow_class(self._name, self._func_name, self.hass)
+
+        flow_result = await self._func_flow.async_parse_user_input(user_input)
+        logger.debug("<%s> async_step_%s: %s", self._name, self._func_name, flow_result)
 
         if not flow_result.create_entry:
             return self.async_show_form(
@@ -339,20 +384,25 @@ class OhMyLightOptionsFlow(OptionsFlow):
     配置选项，用于用户修改配置
     """
 
+    _func_flow: OhMyLightBaseFlowManager | None = None
+
     async def async_step_init(self, user_input: dict[str, Any] | None = None) -> FlowResult:
-        logger.debug(f"<{self.config_entry.title}> async_step_init: {user_input}")
+        logger.debug("<%s> async_step_init: %s", self.config_entry.title, user_input)
         func_name = self.config_entry.data.get("func_name")
         entry_name = self.config_entry.title
 
-        flow_class = FLOW_CLASS_MAP.get(func_name)
-        if not flow_class:
-            return self.async_abort(reason="unknown_func_name")
-        func_flow = flow_class(entry_name, func_name, self.hass)
+        # 同一流程的多次提交复用同一个func_flow，以复用其中的解析缓存
+        if self._func_flow is None:
+            flow_class = FLOW_CLASS_MAP.get(func_name)
+            if not flow_class:
+                return self.async_abort(reason="unknown_func_name")
+            self._func_flow = flow_class(entry_name, func_name, self.hass, entry_id=self.config_entry.entry_id)
+        func_flow = self._func_flow
 
         if user_input is not None:
             # 用户有输入，尝试解析输入
             flow_result = await func_flow.async_parse_user_input(user_input)
-            logger.debug(f"<{entry_name}> async_step_{func_name}: {flow_result.as_dict()}")
+            logger.debug("<%s> async_step_%s: %s", entry_name, func_name, flow_result)
             if not flow_result.create_entry:
                 return self.async_show_form(
                     step_id="init",
@@ -1,14 +1,19 @@
-import datetime
+import asyncio
 import logging
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Callable, Coroutine, Iterable, Mapping
 from dataclasses import dataclass
+from functools import partial
+from typing import Any
 
 from homeassistant.config_entries import ConfigEntry, ConfigEntryState
 from homeassistant.const import STATE_OFF, STATE_ON, STATE_UNAVAILABLE
-from homeassistant.core import Event, HomeAssistant, callback
+from homeassistant.core import Context, Event, HomeAssistant, State, callback
+from homeassistant.helpers.debounce import Debouncer
 from homeassistant.helpers.event import async_track_state_change_event
 
-from .const import FUNC_NAME_LIGHT_EVENT_BIND, FUNC_NAME_LIGHT_SWITCH_BIND, FUNC_NAME_LIGHT_SYNC
+from .const import DOMAIN, FUNC_NAME_LIGHT_EVENT_BIND, FUNC_NAME_LIGHT_SWITCH_BIND, FUNC_NAME_LIGHT_SYNC
 from .utils import async_parse_light, async_whether_light_listen_by_other
 
 logger = logging.getLogger(__name__)
@@ -23,6 +28,49 @@ SWITCH_SERVICES = {
     STATE_OFF: "turn_off",
 }
 
+# 实体状态变化事件的处理函数
+EventHandler = Callable[[Event], Coroutine[Any, Any, None]]
+
+# 同一实体连续状态变化的去抖冷却时间(秒)，冷却期间的变化合并为一次扇出
+FANOUT_DEBOUNCE_COOLDOWN = 0.15
+
+# 灯同步时需要同步的灯属性
+LIGHT_SYNC_ATTRIBUTES = frozenset({"brightness", "color_temp_kelvin"})
+
+# 判断灯亮度是否已经一致时允许的误差
+BRIGHTNESS_TOLERANCE = 1
+
+# 记录协调器自身发起的服务调用context的数量上限，用于识别扇出引起的回声事件
+OWN_CONTEXT_CACHE_SIZE = 256
+
+
+def _list_invalid_entity_ids(entity_ids: Iterable[str], domain: str) -> list[str]:
+    """返回不属于指定domain的实体id"""
+    prefix = f"{domain}."
+    return sorted(entity_id for entity_id in entity_ids if not entity_id.startswith(prefix))
+
+
+def _light_state_matches(current_state: State | None, desired_state: str, desired_attributes: Mapping) -> bool:
+    """判断灯当前的状态和需要同步的属性是否已经与期望的一致"""
+    if current_state is None or current_state.state != desired_state:
+        return False
+    if desired_state == STATE_OFF:
+        return True
+    current_attributes = current_state.attributes
+    for attribute in LIGHT_SYNC_ATTRIBUTES:
+        desired_value = desired_attributes.get(attribute)
+        if desired_value is None:
+            continue
+        current_value = current_attributes.get(attribute)
+        if current_value is None:
+            return False
+        if attribute == "brightness":
+            if abs(current_value - desired_value) > BRIGHTNESS_TOLERANCE:
+                return False
+        elif current_value != desired_value:
+            return False
+    return True
+
 
 @dataclass
 class ListenResult:
@@ -35,20 +83,41 @@ class ListenResult:
 
 
 class BaseCoordinator(ABC):
+    # 每个配置项对应一个协调器，使用__slots__省去实例__dict__
+    __slots__ = (
+        "_all_fanout_ids",
+        "_async_call_service",
+        "_debouncers",
+        "_lights_of_group",
+        "_listened_entity_ids",
+        "_own_context_ids",
+        "_title",
+        "_unsub_callbacks",
+        "config_entry",
+        "func_data",
+        "func_name",
+        "hass",
+    )
+
     def __init__(self, hass: HomeAssistant, entry: ConfigEntry) -> None:
         self.hass: HomeAssistant = hass
         self.config_entry: ConfigEntry = entry
-        setattr(self.config_entry, "coordinator", self)
+        # 缓存配置项标题，日志频繁使用
+        self._title: str = entry.title
+        # 扇出时频繁调用服务，缓存绑定方法
+        self._async_call_service = hass.services.async_call
         self.func_name: str = self.config_entry.data["func_name"]
         self.func_data: dict = self.config_entry.data["func_data"]
         self._unsub_callbacks: list[callable] = []
-        # 被扇出的实体id，用于避免循环更新
-        self._fanned_out_entity_ids: set[str] = set[str]()
-        self._last_update_timestamp = 0
+        # 最近扇出时使用的context id，由这些context引起的状态变化是回声，不再扇出，避免循环更新
+        self._own_context_ids: OrderedDict[str, None] = OrderedDict()
         # 缓存本Coordinator监听的所有灯实体id
-        self._listened_entity_ids: set[str] = set[str]()
+        self._listened_entity_ids: frozenset[str] = frozenset()
         self._lights_of_group: dict[str, set[str]] = {}
-        self._lights_in_group: set[str] = set[str]()
+        # 缓存灯同步涉及的所有实体id，包括灯组和灯组中的所有灯实体
+        self._all_fanout_ids: frozenset[str] = frozenset()
+        # 每个触发扇出的实体对应一个去抖器
+        self._debouncers: dict[str, Debouncer] = {}
 
     @abstractmethod
     async def async_list_entities_to_listen(self) -> ListenResult:
@@ -56,18 +125,16 @@ class BaseCoordinator(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    async def async_handle_event(self, event: Event):
-        """处理实体状态变化事件"""
+    def _get_event_handlers(self, entity_ids: set[str]) -> dict[tuple[str, ...], EventHandler]:
+        """返回分组监听的实体id及每组对应的事件处理函数"""
         raise NotImplementedError
 
     async def async_setup(self):
-        logger.debug(f"<{self.config_entry.title}> Setting up coordinator")
+        logger.debug("<%s> Setting up coordinator", self._title)
         # 获取需要监听状态变化的实体id列表
         listener_result = await self.async_list_entities_to_listen()
         if not listener_result.satisfied:
-            logger.warning(
-                f"<{self.config_entry.title}> No entity ids to listen, reason: {listener_result.unsatisfied_reason}"
-            )
+            logger.warning("<%s> No entity ids to listen, reason: %s", self._title, listener_result.unsatisfied_reason)
             # 禁用该entry的监听功能
             await self.async_unload()
             self.config_entry._async_set_state(
@@ -79,103 +146,158 @@ class BaseCoordinator(ABC):
             )
             return
 
-        logger.debug(f"<{self.config_entry.title}> Coordinator will listen entity ids: {listener_result.entity_ids}")
+        logger.debug("<%s> Coordinator will listen entity ids: %s", self._title, listener_result.entity_ids)
 
-        @callback
-        async def handle_event(event: Event) -> None:
-            logger.debug(f"<{self.config_entry.title}> {self.func_name} event: {event.as_dict()}")
-            await self.async_handle_event(event)
+        # 按分组发起监听实体状态变化事件，每组事件直接交给对应的处理函数
+        for entity_ids, event_handler in self._get_event_handlers(listener_result.entity_ids).items():
+            self._async_track_entities(entity_ids, event_handler)
+        logger.debug("<%s> Listening entity ids: %s", self._title, listener_result.entity_ids)
+        self._async_update_listened_entity_ids(listener_result.entity_ids)
 
-        # 发起监听实体状态变化事件
-        unsub_callback = async_track_state_change_event(
-            self.hass,
-            listener_result.entity_ids,
-            handle_event,
+    def _invalid_light_entity_ids_result(self, invalid_entity_ids: list[str]) -> ListenResult:
+        """配置中存在非灯实体时的监听结果"""
+        logger.error("<%s> Entities %s are not light entities", self._title, invalid_entity_ids)
+        return ListenResult(
+            satisfied=False,
+            entity_ids=None,
+            unsatisfied_reason="invalid_light_entity_ids",
+            unsatisfied_reason_placeholders={"invalid_entity_ids": ",".join(invalid_entity_ids)},
         )
+
+    @callback
+    def _async_track_entities(self, entity_ids: Iterable[str], event_handler: EventHandler) -> None:
+        """
+        监听实体状态变化事件，并直接交给指定的处理函数
+        处理函数是协程函数，Home Assistant会为每个事件创建立即开始执行的任务，无需再包装一层回调
+        """
+        unsub_callback = async_track_state_change_event(self.hass, entity_ids, event_handler)
         self._unsub_callbacks.append(unsub_callback)
-        logger.debug(f"<{self.config_entry.title}> Listening entity ids: {listener_result.entity_ids}")
-        self._listened_entity_ids = listener_result.entity_ids
+
+    @callback
+    def _async_log_event(self, event: Event) -> None:
+        """记录收到的事件，只在开启DEBUG日志时才序列化事件"""
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("<%s> %s event: %s", self._title, self.func_name, event.as_dict())
 
     async def async_unload(self):
-        logger.debug(f"<{self.config_entry.title}> Unloading coordinator")
+        logger.debug("<%s> Unloading coordinator", self._title)
         for unsub_callback in self._unsub_callbacks:
             unsub_callback()
         self._unsub_callbacks.clear()
+        for debouncer in self._debouncers.values():
+            debouncer.async_cancel()
+        self._debouncers.clear()
+        # 释放灯组和扇出相关的缓存
+        self._own_context_ids.clear()
+        self._lights_of_group = {}
+        # 停止监听后释放占用的灯实体，避免其他配置项误判冲突
+        self._async_update_listened_entity_ids(frozenset())
+
+    @callback
+    def _async_update_listened_entity_ids(self, entity_ids: Iterable[str]) -> None:
+        """更新本协调器监听的实体id，并同步到协调器管理器维护的索引中"""
+        coordinator_manager: OhMyLightCoordinatorManager = self.hass.data[DOMAIN]["coordinator_manager"]
+        coordinator_manager.async_unregister_listened_entity_ids(self)
+        # 保存为不可变的快照，避免外部修改传入的集合影响索引
+        self._listened_entity_ids = frozenset(entity_ids)
+        coordinator_manager.async_register_listened_entity_ids(self)
+
+    async def _async_debounced_fan_out(self, entity_id: str, fan_out: Callable[[], Coroutine[Any, Any, None]]) -> None:
+        """
+        按实体去抖执行扇出，第一次变化立即扇出，冷却期间的后续变化合并为冷却结束后的一次扇出
+        """
+        if (debouncer := self._debouncers.get(entity_id)) is None:
+            debouncer = self._debouncers[entity_id] = Debouncer(
+                self.hass,
+                logger,
+                cooldown=FANOUT_DEBOUNCE_COOLDOWN,
+                immediate=True,
+                function=fan_out,
+            )
+        await debouncer.async_call()
+
+    @callback
+    def _async_new_fanout_context(self, parent: Context | None = None) -> Context:
+        """创建扇出服务调用使用的context，并记录下来用于识别回声事件"""
+        context = Context(parent_id=parent.id if parent else None)
+        own_context_ids = self._own_context_ids
+        own_context_ids[context.id] = None
+        if len(own_context_ids) > OWN_CONTEXT_CACHE_SIZE:
+            own_context_ids.popitem(last=False)
+        return context
+
+    def _is_echo_event(self, event: Event) -> bool:
+        """判断事件是否由本协调器的扇出引起"""
+        return event.context.id in self._own_context_ids
+
+    async def _async_gather_service_calls(self, *coros: Coroutine[Any, Any, None]) -> None:
+        """并发执行服务调用，服务调用方法自行捕获并记录失败，单个调用失败不影响其他调用"""
+        # 立即开始执行每个服务调用，直到第一次真正挂起时才交还事件循环，省去每个任务的一次调度
+        tasks = [self.hass.async_create_task(coro, eager_start=True) for coro in coros]
+        await asyncio.gather(*tasks)
 
     async def _async_set_light_entity_state(
         self,
-        entity_id: str,
+        entity_id: str | list[str],
         desired_state: str,
-        desired_attributes: dict = {},
+        desired_attributes: Mapping[str, Any] | None = None,
+        context: Context | None = None,
     ) -> None:
-        logger.debug(f"Setting entity {entity_id} to state {desired_state} with attributes {desired_attributes}")
-        domain = entity_id.split(".")[0]
-        if domain != "light":
-            logger.error(f"Entity {entity_id} is not a light entity")
-            return
-
-        # 校验desired_state是否为on或off
-        if desired_state not in [STATE_ON, STATE_OFF]:
-            logger.error(f"Invalid desired state {desired_state}")
+        """
+        设置灯实体状态，entity_id为列表时通过一次服务调用批量设置
+        实体id在setup时已校验为灯实体，desired_state由调用方保证为on或off
+        """
+        logger.debug("Setting entity %s to state %s with attributes %s", entity_id, desired_state, desired_attributes)
+        if not entity_id:
             return
 
-        # 处理desired_attributes
-        if desired_state == STATE_OFF:
-            desired_attributes = {}
-        if desired_attributes:
-            desired_attributes = {
-                k: v
-                for k, v in desired_attributes.items()
-                if k
-                in [
-                    "brightness",
-                    "color_temp_kelvin",
-                ]
-                and v is not None
-            }
+        # 直接构造服务调用参数，关灯时不携带属性，开灯时只携带需要同步且有值的属性
+        service_data: dict[str, Any] = {"entity_id": entity_id}
+        if desired_state == STATE_ON and desired_attributes:
+            for attribute in desired_attributes.keys() & LIGHT_SYNC_ATTRIBUTES:
+                if (value := desired_attributes[attribute]) is not None:
+                    service_data[attribute] = value
 
         try:
             # 调用Home Assistant服务来设置实体状态
-            await self.hass.services.async_call(
-                domain,
-                LIGHT_SERVICES[desired_state],
-                {**{"entity_id": entity_id, **desired_attributes}},
-            )
-            logger.info(f"Successfully set {entity_id} to state {desired_state} with attributes {desired_attributes}")
+            await self._async_call_service("light", LIGHT_SERVICES[desired_state], service_data, context=context)
+            logger.info("Successfully set light to state %s with service data %s", desired_state, service_data)
         except Exception:
             logger.error(
-                f"Failed to set {entity_id} to state {desired_state} with attributes {desired_attributes}",
+                "Failed to set light to state %s with service data %s",
+                desired_state,
+                service_data,
                 exc_info=True,
             )
 
     async def _async_set_switch_entity_state(
         self,
-        entity_id: str,
+        entity_id: str | list[str],
         desired_state: str,
+        context: Context | None = None,
     ) -> None:
-        logger.debug(f"Setting switch {entity_id} to state {desired_state} ")
-        domain = entity_id.split(".")[0]
-
-        if domain != "switch":
-            logger.error(f"Entity {entity_id} is not a switch entity")
-            return
-
-        # 校验desired_state是否为on或off
-        if desired_state not in [STATE_ON, STATE_OFF]:
-            logger.error(f"Invalid desired state {desired_state}")
+        """
+        设置开关实体状态，entity_id为列表时通过一次服务调用批量设置
+        实体id在setup时已筛选为开关实体，desired_state由调用方保证为on或off
+        """
+        logger.debug("Setting switch %s to state %s ", entity_id, desired_state)
+        if not entity_id:
             return
 
         try:
             # 调用Home Assistant服务来设置实体状态
-            await self.hass.services.async_call(
-                domain,
+            await self._async_call_service(
+                "switch",
                 SWITCH_SERVICES[desired_state],
                 {"entity_id": entity_id},
+                context=context,
             )
-            logger.info(f"Successfully set {entity_id} to state {desired_state}")
+            logger.info("Successfully set %s to state %s", entity_id, desired_state)
         except Exception:
             logger.error(
-                f"Failed to set {entity_id} to state {desired_state}",
+                "Failed to set %s to state %s",
+                entity_id,
+                desired_state,
                 exc_info=True,
             )
 
@@ -183,37 +305,51 @@ class BaseCoordinator(ABC):
 class LightSyncCoordinator(BaseCoordinator):
     """灯同步协调器"""
 
+    __slots__ = ("_sync_entity_ids",)
+
+    def __init__(self, hass: HomeAssistant, entry: ConfigEntry) -> None:
+        super().__init__(hass, entry)
+        # 缓存配置的需要同步的灯实体id
+        self._sync_entity_ids: frozenset[str] = frozenset(self.func_data["light_sync_entity_ids"])
+
     async def async_list_entities_to_listen(self) -> ListenResult:
         """返回需要监听状态变化的实体id列表"""
         light_sync_entity_ids = self.func_data["light_sync_entity_ids"]
         if not light_sync_entity_ids:
-            logger.error(f"No any light sync entity ids found in entry {self.config_entry.title}")
+            logger.error("No any light sync entity ids found in entry %s", self._title)
             return ListenResult(
                 satisfied=False,
                 entity_ids=set(light_sync_entity_ids),
-                errors={
-                    "light_sync_entity_ids": f"No any light sync entity ids found in entry {self.config_entry.title}"
-                },
+                errors={"light_sync_entity_ids": f"No any light sync entity ids found in entry {self._title}"},
             )
 
+        if invalid_entity_ids := _list_invalid_entity_ids(self._sync_entity_ids, "light"):
+            return self._invalid_light_entity_ids_result(invalid_entity_ids)
+
         # 判断是否有灯实体id在其他配置项中被监听，如果有监听则提示并让用户修改输入
         (
             normal_light_entity_ids,
             light_of_group_entity_ids,
-        ) = await async_parse_light(self.hass, light_sync_entity_ids)
+        ) = async_parse_light(self.hass, self._sync_entity_ids)
+        # 灯组中的灯只展开一次，冲突检查和监听列表共用
+        lights_in_group = frozenset().union(*light_of_group_entity_ids.values())
+        entity_ids_to_listen = normal_light_entity_ids | lights_in_group
 
         (
             existing_light_entity_ids,
             existing_config_entry,
-        ) = await async_whether_light_listen_by_other(
+        ) = async_whether_light_listen_by_other(
             self.hass,
-            self.config_entry.title,
+            self.config_entry.entry_id,
             self.func_name,
-            normal_light_entity_ids.union(*light_of_group_entity_ids.values()),
+            entity_ids_to_listen,
         )
         if existing_light_entity_ids:
             logger.error(
-                f"<{self.config_entry.title}> Light entity ids {existing_light_entity_ids} are listened by entry {existing_config_entry.title}"
+                "<%s> Light entity ids %s are listened by entry %s",
+                self._title,
+                existing_light_entity_ids,
+                existing_config_entry.title,
             )
             return ListenResult(
                 satisfied=False,
@@ -224,29 +360,34 @@ class LightSyncCoordinator(BaseCoordinator):
                     "existing_config_entry_id": existing_config_entry.title,
                 },
             )
-        self._lights_in_group = set[str]().union(*light_of_group_entity_ids.values())
         self._lights_of_group = light_of_group_entity_ids
+        self._all_fanout_ids = self._sync_entity_ids.union(light_of_group_entity_ids.keys(), lights_in_group)
+        entity_ids_to_listen |= light_of_group_entity_ids.keys()
         return ListenResult(
             satisfied=True,
-            entity_ids=normal_light_entity_ids.union(
-                light_of_group_entity_ids.keys(), *light_of_group_entity_ids.values()
-            ),
+            entity_ids=entity_ids_to_listen,
         )
 
+    def _get_event_handlers(self, entity_ids: set[str]) -> dict[tuple[str, ...], EventHandler]:
+        """所有实体共用async_handle_event处理事件"""
+        return {tuple(entity_ids): self.async_handle_event}
+
     async def async_handle_event(self, event: Event):
         """处理实体状态变化事件"""
 
-        old_state = event.data.get("old_state")
+        self._async_log_event(event)
+        data = event.data
+        old_state = data.get("old_state")
         if not old_state:
             logger.debug("No old state found, skip")
             return
 
-        entity_id = event.data.get("entity_id")
+        entity_id = data.get("entity_id")
         if not entity_id:
             logger.error("No entity id found in event data")
             return
 
-        new_state = event.data.get("new_state")
+        new_state = data.get("new_state")
         if not new_state:
             logger.error("No new state found in event data")
             return
@@ -258,203 +399,344 @@ class LightSyncCoordinator(BaseCoordinator):
 
         # 如果变更entity是灯组且old_state是unavailable，则说明灯组的灯发生了变更，重新监听灯组中的所有灯实体
         if entity_id in self._lights_of_group and old_state.state == STATE_UNAVAILABLE:
-            logger.debug(f"Light group entity {entity_id} old state is unavailable, refresh and listen lights in group")
-            await self.async_unload()
-            await self.async_setup()
+            logger.debug(
+                "Light group entity %s old state is unavailable, refresh and listen lights in group", entity_id
+            )
+            await self._async_refresh_lights_in_group()
             return
 
         # 如果new_state不是on或者off，可能是灯离线了，直接返回不做处理
         if state not in [STATE_ON, STATE_OFF]:
-            logger.debug(f"Ingore this event, state <{state}> is not in {[STATE_ON, STATE_OFF]}")
+            logger.debug("Ingore this event, state <%s> is not in %s", state, [STATE_ON, STATE_OFF])
             return
 
-        # 清空被扇出的实体id
-        if not self._last_update_timestamp or event.time_fired - self._last_update_timestamp > datetime.timedelta(
-            seconds=3
+        # 状态和需要同步的属性都没有变化，不做处理
+        old_attributes = old_state.attributes
+        new_attributes = new_state.attributes
+        if old_state.state == state and all(
+            old_attributes.get(attribute) == new_attributes.get(attribute) for attribute in LIGHT_SYNC_ATTRIBUTES
         ):
-            logger.debug("Clear fanned out entity ids")
-            self._fanned_out_entity_ids.clear()
+            logger.debug("Ingore this event, entity %s state and attributes not changed", entity_id)
+            return
 
-        # 如果变更的entity_id在被扇出的实体id中，直接返回不做处理
-        entity_id = event.data.get("entity_id")
-        if entity_id in self._fanned_out_entity_ids:
-            logger.debug(f"<{self.config_entry.title}> Ingore this event, entity {entity_id} is fanned out")
+        # 变更是本协调器扇出引起的回声，直接返回不做处理
+        if self._is_echo_event(event):
+            logger.debug("<%s> Ingore this event, entity %s is fanned out", self._title, entity_id)
             return
 
-        # 将所有其他的灯实体放到扇出队列中，包括灯组和灯组中的所有灯实体
-        self._fanned_out_entity_ids.update(
-            [
-                e
-                for e in (
-                    set(self.func_data["light_sync_entity_ids"])
-                    .union(self._lights_of_group.keys())
-                    .union(self._lights_in_group)
-                )
-                if e != entity_id
-            ]
-        )
+        # 灯组的汇总状态随组内灯的直接变化而更新，由组内灯自身的事件负责扇出，灯组不再扇出以免与之竞争
+        if entity_id in self._lights_of_group and self._is_group_update_from_member(entity_id, old_state, new_state):
+            logger.debug("<%s> Ingore this event, light group %s is updated by its lights", self._title, entity_id)
+            return
 
-        # 将需要变更的实体添加到需要更新的实体id队列中
-        need_update_entity_ids = set[str](self.func_data["light_sync_entity_ids"])
-        if entity_id in need_update_entity_ids:
-            need_update_entity_ids.remove(entity_id)
+        await self._async_debounced_fan_out(entity_id, partial(self._async_fan_out, entity_id))
+
+    def _is_group_update_from_member(self, group_entity_id: str, old_state: State, new_state: State) -> bool:
+        """
+        判断灯组的状态变化是否由组内灯的直接变化引起
+        对灯组本身的操作会以同一个context修改组内灯，组内灯在灯组上次更新后以其他context发生变化时，说明是组内灯被直接修改
+        """
+        states_get = self.hass.states.get
+        for light_entity_id in self._lights_of_group[group_entity_id]:
+            light_state = states_get(light_entity_id)
+            if (
+                light_state is not None
+                and light_state.last_updated > old_state.last_updated
+                and light_state.context.id != new_state.context.id
+            ):
+                return True
+        return False
+
+    async def _async_refresh_lights_in_group(self) -> None:
+        """
+        重新解析灯组中的灯实体，只为新加入灯组的灯追加监听
+        有灯被移出灯组或新加入的灯被其他配置项监听时，退回到完整的重新监听
+        """
+        old_ids = self._all_fanout_ids
+        _, light_of_group_entity_ids = async_parse_light(self.hass, self._sync_entity_ids)
+        lights_in_group = frozenset().union(*light_of_group_entity_ids.values())
+        all_fanout_ids = self._sync_entity_ids.union(light_of_group_entity_ids.keys(), lights_in_group)
+        new_ids = all_fanout_ids - old_ids
+        if new_ids:
+            existing_light_entity_ids, _ = async_whether_light_listen_by_other(
+                self.hass, self.config_entry.entry_id, self.func_name, new_ids
+            )
+        else:
+            existing_light_entity_ids = None
+        if existing_light_entity_ids or old_ids - all_fanout_ids:
+            await self.async_unload()
+            await self.async_setup()
+            return
 
-        # 修改所有灯光状态
-        for light_entity_id in need_update_entity_ids:
-            await self._async_set_light_entity_state(light_entity_id, state, new_state.attributes)
+        self._lights_of_group = light_of_group_entity_ids
+        self._all_fanout_ids = all_fanout_ids
+        if not new_ids:
+            return
+        logger.debug("<%s> Listening new lights in group: %s", self._title, new_ids)
+        self._async_track_entities(new_ids, self.async_handle_event)
+        self._async_update_listened_entity_ids(self._listened_entity_ids | new_ids)
+
+    async def _async_fan_out(self, entity_id: str) -> None:
+        """将实体的最新状态同步到其他灯"""
+        # 去抖合并后的扇出可能晚于事件执行，以实体的最新状态为准
+        latest_state = self.hass.states.get(entity_id)
+        if not latest_state or latest_state.state not in [STATE_ON, STATE_OFF]:
+            logger.debug("Ingore fan out, entity %s latest state is not in %s", entity_id, [STATE_ON, STATE_OFF])
+            return
 
-        self._last_update_timestamp = event.time_fired
+        # 需要更新的实体为除变更实体外的所有同步灯实体，跳过状态和属性已经一致的灯
+        # 灯组的状态是组内灯的汇总，无法据此判断组内每个灯都已一致，灯组总是需要更新
+        states_get = self.hass.states.get
+        state = latest_state.state
+        attributes = latest_state.attributes
+        need_update_entity_ids = [
+            light_entity_id
+            for light_entity_id in self._sync_entity_ids - {entity_id}
+            if light_entity_id in self._lights_of_group
+            or not _light_state_matches(states_get(light_entity_id), state, attributes)
+        ]
+
+        # 一次服务调用批量修改所有灯光状态
+        await self._async_set_light_entity_state(
+            need_update_entity_ids, state, attributes, self._async_new_fanout_context(latest_state.context)
+        )
 
 
 class LightSwitchBindCoordinator(BaseCoordinator):
     """灯开关绑定协调器"""
 
+    __slots__ = ("_all_ids", "_light_ids", "_settable_switch_ids", "_switch_ids")
+
+    def __init__(self, hass: HomeAssistant, entry: ConfigEntry) -> None:
+        super().__init__(hass, entry)
+        # 缓存绑定的灯和开关实体id集合，事件处理时O(1)判断
+        self._light_ids: frozenset[str] = frozenset(self.func_data["light_entity_ids"])
+        self._switch_ids: frozenset[str] = frozenset(self.func_data["switch_entity_ids"])
+        self._all_ids: frozenset[str] = self._light_ids | self._switch_ids
+        # 二进制传感器只能作为触发源，扇出时只设置开关实体
+        self._settable_switch_ids: frozenset[str] = frozenset(
+            switch_entity_id for switch_entity_id in self._switch_ids if switch_entity_id.startswith("switch.")
+        )
+
     async def async_list_entities_to_listen(self) -> ListenResult:
         """返回需要监听状态变化的实体id列表"""
-        light_entity_ids = self.func_data["light_entity_ids"]
-        switch_entity_ids = self.func_data["switch_entity_ids"]
+        if invalid_entity_ids := _list_invalid_entity_ids(self._light_ids, "light"):
+            return self._invalid_light_entity_ids_result(invalid_entity_ids)
         return ListenResult(
             satisfied=True,
-            entity_ids=set(light_entity_ids + switch_entity_ids),
+            entity_ids=set(self._all_ids),
         )
 
-    async def async_handle_event(self, event: Event):
-        """处理实体状态变化事件"""
-        light_entity_ids = self.func_data["light_entity_ids"]
-        switch_entity_ids = self.func_data["switch_entity_ids"]
+    def _get_event_handlers(self, entity_ids: set[str]) -> dict[tuple[str, ...], EventHandler]:
+        """灯和开关分开监听，事件处理时无需再判断实体属于哪一组"""
+        return {
+            tuple(self._light_ids): self._async_handle_light_event,
+            tuple(self._switch_ids): self._async_handle_switch_event,
+        }
 
-        old_state = event.data.get("old_state")
+    async def _async_handle_light_event(self, event: Event):
+        """处理灯实体状态变化事件，同步到其他灯和所有开关"""
+        entity_id = event.data.get("entity_id")
+        await self._async_sync_state(event, self._light_ids - {entity_id}, self._settable_switch_ids)
+
+    async def _async_handle_switch_event(self, event: Event):
+        """处理开关实体状态变化事件，同步到所有灯和其他开关"""
+        entity_id = event.data.get("entity_id")
+        await self._async_sync_state(event, self._light_ids, self._settable_switch_ids - {entity_id})
+
+    async def _async_sync_state(
+        self, event: Event, light_entity_ids: frozenset[str], switch_entity_ids: frozenset[str]
+    ):
+        """将事件中实体的新状态同步到指定的灯和开关"""
+        self._async_log_event(event)
+        data = event.data
+        old_state = data.get("old_state")
         if not old_state:
             logger.debug("No old state found, skip")
             return
 
-        entity_id = event.data.get("entity_id")
+        entity_id = data.get("entity_id")
         if not entity_id:
             logger.error("No entity id found in event data")
             return
 
-        new_state = event.data.get("new_state")
+        new_state = data.get("new_state")
         if not new_state:
             logger.error("No new state found in event data")
             return
 
-        # 清空被扇出的实体id
-        if not self._last_update_timestamp or event.time_fired - self._last_update_timestamp > datetime.timedelta(
-            seconds=3
-        ):
-            logger.debug("Clear fanned out entity ids")
-            self._fanned_out_entity_ids.clear()
+        # 开关状态没有变化(如仅属性变化)，不做处理
+        if old_state.state == new_state.state:
+            logger.debug("Ingore this event, entity %s state not changed", entity_id)
+            return
 
-        if entity_id not in light_entity_ids + switch_entity_ids:
-            logger.error(f"Unknown entity id {entity_id} in entry {self.config_entry.title}")
+        # 变更是本协调器扇出引起的回声，直接返回不做处理
+        if self._is_echo_event(event):
+            logger.debug("<%s> Ingore this event, entity %s is fanned out", self._title, entity_id)
             return
 
-        need_update_entity_ids = set[str](light_entity_ids + switch_entity_ids)
-        self._fanned_out_entity_ids.update(light_entity_ids)
-        if entity_id in need_update_entity_ids:
-            need_update_entity_ids.remove(entity_id)
-        # 修改所有灯光和开关状态
-        for entity_id in need_update_entity_ids:
-            if entity_id in light_entity_ids:
-                await self._async_set_light_entity_state(entity_id, new_state.state)
-                logger.debug(f"Set light entity {entity_id} state to {new_state.state}")
-            elif entity_id in switch_entity_ids:
-                await self._async_set_switch_entity_state(entity_id, new_state.state)
-                logger.debug(f"Set switch entity {entity_id} state to {new_state.state}")
+        await self._async_debounced_fan_out(
+            entity_id, partial(self._async_fan_out, entity_id, light_entity_ids, switch_entity_ids)
+        )
+
+    async def _async_fan_out(
+        self, entity_id: str, light_entity_ids: frozenset[str], switch_entity_ids: frozenset[str]
+    ) -> None:
+        """将实体的最新状态同步到指定的灯和开关"""
+        # 去抖合并后的扇出可能晚于事件执行，以实体的最新状态为准
+        latest_state = self.hass.states.get(entity_id)
+        if not latest_state:
+            logger.error("Entity %s not found", entity_id)
+            return
+        if latest_state.state not in [STATE_ON, STATE_OFF]:
+            logger.debug("Ingore fan out, entity %s latest state is not in %s", entity_id, [STATE_ON, STATE_OFF])
+            return
 
-        self._last_update_timestamp = event.time_fired
+        # 跳过状态已经一致的灯和开关
+        states_get = self.hass.states.get
+        state = latest_state.state
+        light_entity_ids = [
+            light_entity_id
+            for light_entity_id in light_entity_ids
+            if (light_state := states_get(light_entity_id)) is None or light_state.state != state
+        ]
+        switch_entity_ids = [
+            switch_entity_id
+            for switch_entity_id in switch_entity_ids
+            if (switch_state := states_get(switch_entity_id)) is None or switch_state.state != state
+        ]
+        # 灯和开关各通过一次服务调用批量修改，并发执行，单类实体失败不影响另一类
+        context = self._async_new_fanout_context(latest_state.context)
+        await self._async_gather_service_calls(
+            self._async_set_light_entity_state(light_entity_ids, state, context=context),
+            self._async_set_switch_entity_state(switch_entity_ids, state, context),
+        )
 
 
 class LightEventBindCoordinator(BaseCoordinator):
     """灯事件绑定协调器"""
 
+    __slots__ = ("_event_entity_ids", "_light_entity_ids")
+
+    def __init__(self, hass: HomeAssistant, entry: ConfigEntry) -> None:
+        super().__init__(hass, entry)
+        # 缓存绑定的灯和事件实体id，事件处理时无需再查func_data
+        self._light_entity_ids: tuple[str, ...] = tuple(self.func_data["light_entity_ids"])
+        self._event_entity_ids: frozenset[str] = frozenset(self.func_data["event_entity_ids"])
+
     async def async_list_entities_to_listen(self) -> ListenResult:
         """返回需要监听状态变化的实体id列表"""
-        event_entity_ids = self.func_data["event_entity_ids"]
+        if invalid_entity_ids := _list_invalid_entity_ids(self._light_entity_ids, "light"):
+            return self._invalid_light_entity_ids_result(invalid_entity_ids)
         return ListenResult(
             satisfied=True,
-            entity_ids=set(event_entity_ids),
+            entity_ids=set(self._event_entity_ids),
         )
 
+    def _get_event_handlers(self, entity_ids: set[str]) -> dict[tuple[str, ...], EventHandler]:
+        """所有实体共用async_handle_event处理事件"""
+        return {tuple(entity_ids): self.async_handle_event}
+
     async def async_handle_event(self, event: Event):
         """处理实体状态变化事件"""
-        light_entity_ids = self.func_data["light_entity_ids"]
-        event_entity_ids = self.func_data["event_entity_ids"]
+        light_entity_ids = self._light_entity_ids
 
-        old_state = event.data.get("old_state")
+        self._async_log_event(event)
+        data = event.data
+        old_state = data.get("old_state")
         if not old_state:
             logger.debug("No old state found, skip")
             return
 
-        entity_id = event.data.get("entity_id")
+        entity_id = data.get("entity_id")
         if not entity_id:
             logger.error("No entity id found in event data")
             return
 
-        new_state = event.data.get("new_state")
+        new_state = data.get("new_state")
         if not new_state:
             logger.error("No new state found in event data")
             return
 
-        # 清空被扇出的实体id
-        if not self._last_update_timestamp or event.time_fired - self._last_update_timestamp > datetime.timedelta(
-            seconds=3
-        ):
-            logger.debug("Clear fanned out entity ids")
-            self._fanned_out_entity_ids.clear()
-
-        if entity_id not in event_entity_ids:
-            logger.error(f"Unknown entity id {entity_id} in entry {self.config_entry.title}")
+        if entity_id not in self._event_entity_ids:
+            logger.error("Unknown entity id %s in entry %s", entity_id, self._title)
             return
 
         # 触发了开关单击事件，反转灯开关状态
-        self._fanned_out_entity_ids.update(light_entity_ids)
+        # 先一次性读取所有灯的当前状态，按反转后的状态分组，每组通过一次服务调用批量设置
+        states_get = self.hass.states.get
+        entity_ids_by_state: dict[str, list[str]] = {STATE_ON: [], STATE_OFF: []}
         for light_entity_id in light_entity_ids:
-            light_state = self.hass.states.get(light_entity_id)
+            light_state = states_get(light_entity_id)
             if not light_state:
-                logger.error(f"Light entity {light_entity_id} not found")
+                logger.error("Light entity %s not found", light_entity_id)
                 continue
-            await self._async_set_light_entity_state(
-                light_entity_id,
-                STATE_OFF if light_state.state == STATE_ON else STATE_ON,
-                {},
+            entity_ids_by_state[STATE_OFF if light_state.state == STATE_ON else STATE_ON].append(light_entity_id)
+        logger.debug("Set light entity states: %s", entity_ids_by_state)
+        context = self._async_new_fanout_context(event.context)
+        await self._async_gather_service_calls(
+            *(
+                self._async_set_light_entity_state(entity_ids, desired_state, context=context)
+                for desired_state, entity_ids in entity_ids_by_state.items()
+                if entity_ids
             )
-        logger.debug(
-            f"Set light entity {light_entity_id} state to {STATE_OFF if light_state.state == STATE_ON else STATE_ON}"
         )
 
-        self._last_update_timestamp = event.time_fired
+
+# 功能名称对应的协调器类型
+COORDINATOR_TYPES: dict[str, type[BaseCoordinator]] = {
+    FUNC_NAME_LIGHT_SYNC: LightSyncCoordinator,
+    FUNC_NAME_LIGHT_SWITCH_BIND: LightSwitchBindCoordinator,
+    FUNC_NAME_LIGHT_EVENT_BIND: LightEventBindCoordinator,
+}
 
 
 class OhMyLightCoordinatorManager:
     def __init__(self, hass: HomeAssistant) -> None:
         self.hass: HomeAssistant = hass
+        # config entry id -> 协调器
         self.coordinators: dict[str, BaseCoordinator] = {}
-        self.coordinator_types: map[str, type[BaseCoordinator]] = {
-            FUNC_NAME_LIGHT_SYNC: LightSyncCoordinator,
-            FUNC_NAME_LIGHT_SWITCH_BIND: LightSwitchBindCoordinator,
-            FUNC_NAME_LIGHT_EVENT_BIND: LightEventBindCoordinator,
-        }
+        # 按func_name区分的 实体id -> 监听该实体的config entry 的索引，用于O(1)检查监听冲突
+        self.listened_light_index: dict[str, dict[str, ConfigEntry]] = {}
 
     async def async_setup_coordinator(
-        self, entry_titile: str, func_name: str, config_entry: ConfigEntry
+        self, entry_id: str, func_name: str, config_entry: ConfigEntry
     ) -> BaseCoordinator | None:
         """根据协调器类型设置协调器实例"""
-        if func_name not in self.coordinator_types:
-            logger.error(f"Unknown coordinator type: {func_name}")
+        coordinator_type = COORDINATOR_TYPES.get(func_name)
+        if coordinator_type is None:
+            logger.error("Unknown coordinator type: %s", func_name)
             return None
-        if entry_titile in self.coordinators:
-            logger.debug(f"Coordinator {entry_titile} already setup, return existing coordinator")
-            await self.async_unload_coordinator(entry_titile)
-
-        logger.debug(f"Setting up coordinator {entry_titile} with type {func_name}")
-        self.coordinators[entry_titile] = self.coordinator_types[func_name](self.hass, config_entry)
-        await self.coordinators[entry_titile].async_setup()
-        return self.coordinators[entry_titile]
+        if entry_id in self.coordinators:
+            logger.debug("Coordinator %s already setup, unload existing coordinator", entry_id)
+            await self.async_unload_coordinator(entry_id)
+
+        logger.debug("Setting up coordinator %s with type %s", entry_id, func_name)
+        coordinator = self.coordinators[entry_id] = coordinator_type(self.hass, config_entry)
+        await coordinator.async_setup()
+        return coordinator
+
+    @callback
+    def async_register_listened_entity_ids(self, coordinator: BaseCoordinator) -> None:
+        """将协调器监听的实体id加入索引"""
+        index = self.listened_light_index.setdefault(coordinator.func_name, {})
+        for entity_id in coordinator._listened_entity_ids:
+            index.setdefault(entity_id, coordinator.config_entry)
+
+    @callback
+    def async_unregister_listened_entity_ids(self, coordinator: BaseCoordinator) -> None:
+        """将协调器监听的实体id从索引中移除"""
+        index = self.listened_light_index.get(coordinator.func_name)
+        if not index:
+            return
+        for entity_id in coordinator._listened_entity_ids:
+            if index.get(entity_id) is coordinator.config_entry:
+                del index[entity_id]
 
-    async def async_unload_coordinator(self, entry_titile: str) -> None:
+    async def async_unload_coordinator(self, entry_id: str) -> None:
         """卸载协调器"""
-        logger.debug(f"Unloading coordinator {entry_titile}")
-        if entry_titile in self.coordinators:
-            await self.coordinators[entry_titile].async_unload()
-            del self.coordinators[entry_titile]
+        logger.debug("Unloading coordinator %s", entry_id)
+        # 先从管理器中移除，即使卸载过程中出现异常也不会残留协调器实例
+        coordinator = self.coordinators.pop(entry_id, None)
+        if coordinator is not None:
+            await coordinator.async_unload()
@@ -1,96 +1,112 @@
 import logging
+import time
+from collections import defaultdict
+from collections.abc import Iterable
 
 from homeassistant.components.group.light import LightGroup
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 from homeassistant.helpers.entity_component import EntityComponent
 
 from .const import DOMAIN
 
 logger = logging.getLogger(__name__)
 
+# 灯组判断结果的缓存有效期(秒)
+LIGHT_GROUP_CACHE_TTL = 30.0
 
-async def is_light_group_entity(hass: HomeAssistant, entity_id: str) -> bool:
+
+def is_light_group_entity(hass: HomeAssistant, entity_id: str, entity_component: EntityComponent | None = None) -> bool:
     """
-    判断一个entity_id是否是灯组
+    判断一个entity_id是否是灯组，批量判断时可传入已获取的灯EntityComponent
     """
     if not entity_id:
         return False
     if not entity_id.startswith("light."):
         return False
-    entity_component: EntityComponent = hass.data.get("entity_components", {}).get("light")
+    # 实体是否是灯组几乎不会变化，缓存判断结果，过期后重新判断
+    # 首次添加配置项时配置流程先于集成的async_setup运行，hass.data中可能还没有本集成的数据
+    group_cache: dict[str, tuple[bool, float]] = hass.data.setdefault(DOMAIN, {}).setdefault("light_group_cache", {})
+    now = time.monotonic()
+    if (cached := group_cache.get(entity_id)) is not None and now - cached[1] < LIGHT_GROUP_CACHE_TTL:
+        return cached[0]
+    if entity_component is None:
+        entity_component = hass.data.get("entity_components", {}).get("light")
     light_entity = entity_component.get_entity(entity_id)
     if light_entity is None:
-        logger.error(f"Light entity {entity_id} not found")
+        logger.error("Light entity %s not found", entity_id)
         return False
-    return isinstance(light_entity, LightGroup)
-
-
-async def async_list_light_in_light_group(hass: HomeAssistant, light_group_entity_ids: list[str]) -> set[str]:
-    """
-    获取灯组中的所有灯实体id
-    """
-    light_entity_id_set = set[str]()
-    for light_group_entity_id in light_group_entity_ids:
-        light_group_entity = hass.states.get(light_group_entity_id)
-        if light_group_entity is None:
-            logger.error(f"Light group entity {light_group_entity_id} not found")
-            continue
-        light_entity_ids = light_group_entity.attributes.get("entity_id")
-        if light_entity_ids:
-            light_entity_id_set.update(light_entity_ids)
-    return light_entity_id_set
+    is_light_group = isinstance(light_entity, LightGroup)
+    group_cache[entity_id] = (is_light_group, now)
+    return is_light_group
 
 
-async def async_parse_light(hass: HomeAssistant, light_entity_ids: list[str]) -> tuple[set[str], dict[str, set[str]]]:
+@callback
+def async_parse_light(hass: HomeAssistant, light_entity_ids: Iterable[str]) -> tuple[set[str], dict[str, set[str]]]:
     """
     解析灯实体列表，返回普通灯和灯组及灯中包含的普通灯
     """
-    normal_light_entity_ids = set[str]()
-    light_of_group_entity_ids = dict[str, set[str]]()
+    normal_light_entity_ids: set[str] = set()
+    light_of_group_entity_ids: dict[str, set[str]] = {}
+    states_get = hass.states.get
+    entity_component: EntityComponent = hass.data.get("entity_components", {}).get("light")
     for light_entity_id in light_entity_ids:
-        light_entity = hass.states.get(light_entity_id)
+        light_entity = states_get(light_entity_id)
         if light_entity is None:
-            logger.error(f"Light entity {light_entity_id} not found")
+            logger.error("Light entity %s not found", light_entity_id)
             continue
-        if await is_light_group_entity(hass, light_entity_id):
-            light_of_group_entity_ids[light_entity_id] = await async_list_light_in_light_group(hass, [light_entity_id])
+        if is_light_group_entity(hass, light_entity_id, entity_component):
+            # 灯组中的灯直接从已获取的灯组状态中读取
+            light_of_group_entity_ids[light_entity_id] = set(light_entity.attributes.get("entity_id") or ())
         else:
             normal_light_entity_ids.add(light_entity_id)
     return normal_light_entity_ids, light_of_group_entity_ids
 
 
-async def async_list_light_sync_entry(
-    hass: HomeAssistant, domain: str = DOMAIN, func_name: str = None
-) -> list[ConfigEntry]:
+@callback
+def async_get_listened_light_index(hass: HomeAssistant, func_name: str) -> dict[str, ConfigEntry]:
     """
-    获取指定func_name的所有config entry
+    获取指定功能中 灯实体id -> 监听该灯的config entry 的索引
+    索引由协调器管理器在协调器开始或停止监听时维护，集成尚未setup时没有协调器管理器，视为没有灯被监听
     """
+    coordinator_manager = hass.data.get(DOMAIN, {}).get("coordinator_manager")
+    if coordinator_manager is None:
+        return {}
+    return coordinator_manager.listened_light_index.get(func_name, {})
 
-    if func_name is None:
-        return []
-
-    config_entries = hass.config_entries.async_entries(domain)
-    return [config_entry for config_entry in config_entries if config_entry.data["func_name"] == func_name]
 
-
-async def async_whether_light_listen_by_other(
-    hass: HomeAssistant, entry_name: str, func_name: str, light_entity_ids_set: set[str]
+@callback
+def async_whether_light_listen_by_other(
+    hass: HomeAssistant, entry_id: str | None, func_name: str, light_entity_ids_set: set[str] | frozenset[str]
 ) -> tuple[set[str], ConfigEntry | None]:
     """
     检查light_entity_ids_set中的灯实体id是否在其他配置项中被监听，返回被使用了的灯实体和灯组实体id
+    entry_id为当前配置项的id，新建配置项时为None
     """
 
-    for config_entry in await async_list_light_sync_entry(hass, func_name=func_name):
-        if config_entry.title == entry_name:
-            continue
-        if not hasattr(config_entry, "coordinator"):
-            continue
-        coordinator = config_entry.coordinator
-        if not hasattr(coordinator, "_listened_entity_ids"):
-            logger.warning(f"Coordinator {coordinator} has no listened_entity_ids")
+    if not light_entity_ids_set:
+        return set(), None
+
+    index = async_get_listened_light_index(hass, func_name)
+    if not index:
+        return set(), None
+    # 遍历较小的一侧，在另一侧中做哈希查找
+    if len(light_entity_ids_set) <= len(index):
+        listened_light_entity_ids = [entity_id for entity_id in light_entity_ids_set if entity_id in index]
+    else:
+        listened_light_entity_ids = [entity_id for entity_id in index if entity_id in light_entity_ids_set]
+
+    existing_config_entries: dict[str, ConfigEntry] = {}
+    existing_light_entity_ids: dict[str, set[str]] = defaultdict(set)
+    for light_entity_id in listened_light_entity_ids:
+        config_entry = index[light_entity_id]
+        if config_entry.entry_id == entry_id:
             continue
-        listened_entity_ids = coordinator._listened_entity_ids
-        if existing_light_entity_ids := light_entity_ids_set.intersection(listened_entity_ids):
-            return existing_light_entity_ids, config_entry
-    return set(), None
+        existing_config_entries[config_entry.entry_id] = config_entry
+        existing_light_entity_ids[config_entry.entry_id].add(light_entity_id)
+
+    if not existing_config_entries:
+        return set(), None
+    # 只返回第一个存在冲突的config entry
+    conflict_entry_id, conflict_config_entry = next(iter(existing_config_entries.items()))
+    return existing_light_entity_ids[conflict_entry_id], conflict_config_entry
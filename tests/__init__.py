@@ -0,0 +1 @@
+"""Oh My Light集成的测试"""
@@ -0,0 +1,37 @@
+from unittest.mock import patch
+
+from homeassistant import config_entries
+from homeassistant.core import HomeAssistant
+from homeassistant.data_entry_flow import FlowResultType
+from homeassistant.setup import async_setup_component
+
+from custom_components.oh_my_light.const import DOMAIN, FUNC_NAME_LIGHT_SYNC
+
+
+async def test_light_sync_flow_before_integration_setup(hass: HomeAssistant) -> None:
+    """首次添加配置项时集成尚未setup，配置流程不能依赖hass.data中本集成的数据"""
+    await async_setup_component(hass, "light", {})
+    hass.states.async_set("light.a", "on")
+    hass.states.async_set("light.b", "off")
+
+    result = await hass.config_entries.flow.async_init(DOMAIN, context={"source": config_entries.SOURCE_USER})
+    assert result["type"] is FlowResultType.FORM
+    assert result["step_id"] == "user"
+
+    result = await hass.config_entries.flow.async_configure(
+        result["flow_id"], {"name": "Rule1", "func_name": FUNC_NAME_LIGHT_SYNC}
+    )
+    assert result["type"] is FlowResultType.FORM
+    assert result["step_id"] == FUNC_NAME_LIGHT_SYNC
+    assert DOMAIN not in hass.data
+
+    with patch("custom_components.oh_my_light.async_setup_entry", return_value=True):
+        result = await hass.config_entries.flow.async_configure(
+            result["flow_id"], {"light_sync_entity_ids": ["light.a", "light.b"]}
+        )
+    assert result["type"] is FlowResultType.CREATE_ENTRY
+    assert result["title"] == "Rule1"
+    assert result["data"] == {
+        "func_name": FUNC_NAME_LIGHT_SYNC,
+        "func_data": {"light_sync_entity_ids": ["light.a", "light.b"]},
+    }
@@ -0,0 +1,83 @@
+from unittest.mock import AsyncMock, patch
+
+import pytest
+from freezegun.api import FrozenDateTimeFactory
+from homeassistant.const import EVENT_STATE_CHANGED
+from homeassistant.core import Context, Event, HomeAssistant
+from pytest_homeassistant_custom_component.common import MockConfigEntry
+
+from custom_components.oh_my_light.const import DOMAIN, FUNC_NAME_LIGHT_SYNC
+from custom_components.oh_my_light.coordinator import LightSyncCoordinator
+
+
+def _async_set_state(hass: HomeAssistant, entity_id: str, state: str, context: Context, **attributes) -> Event:
+    """修改实体状态，返回对应的状态变化事件"""
+    old_state = hass.states.get(entity_id)
+    hass.states.async_set(entity_id, state, attributes, context=context)
+    return Event(
+        EVENT_STATE_CHANGED,
+        {"entity_id": entity_id, "old_state": old_state, "new_state": hass.states.get(entity_id)},
+        context=context,
+    )
+
+
+@pytest.fixture
+def coordinator(hass: HomeAssistant, freezer: FrozenDateTimeFactory) -> LightSyncCoordinator:
+    """同步light.a和灯组light.g，灯组中包含light.b和light.c"""
+    entry = MockConfigEntry(
+        domain=DOMAIN,
+        title="Rule1",
+        data={"func_name": FUNC_NAME_LIGHT_SYNC, "func_data": {"light_sync_entity_ids": ["light.a", "light.g"]}},
+    )
+    entry.add_to_hass(hass)
+    coordinator = LightSyncCoordinator(hass, entry)
+    coordinator._lights_of_group = {"light.g": {"light.b", "light.c"}}
+    context = Context()
+    for entity_id in ("light.a", "light.b", "light.c", "light.g"):
+        hass.states.async_set(entity_id, "off", context=context)
+    freezer.tick(1)
+    return coordinator
+
+
+@pytest.fixture
+def mock_fan_out():
+    with patch.object(LightSyncCoordinator, "_async_debounced_fan_out", new_callable=AsyncMock) as mock_fan_out:
+        yield mock_fan_out
+
+
+async def test_group_update_from_direct_light_change_is_not_fanned_out(
+    hass: HomeAssistant, freezer: FrozenDateTimeFactory, coordinator: LightSyncCoordinator, mock_fan_out: AsyncMock
+) -> None:
+    """组内灯被直接修改时只由该灯扇出，灯组随之更新的汇总状态不再扇出"""
+    await coordinator.async_handle_event(_async_set_state(hass, "light.b", "on", Context(), brightness=200))
+    freezer.tick(0.01)
+    await coordinator.async_handle_event(_async_set_state(hass, "light.g", "on", Context(), brightness=100))
+
+    assert [call.args[0] for call in mock_fan_out.await_args_list] == ["light.b"]
+
+
+async def test_fan_out_echo_is_not_fanned_out(
+    hass: HomeAssistant, freezer: FrozenDateTimeFactory, coordinator: LightSyncCoordinator, mock_fan_out: AsyncMock
+) -> None:
+    """扇出的服务调用引起的灯和灯组状态变化都不再扇出"""
+    context = coordinator._async_new_fanout_context()
+    await coordinator.async_handle_event(_async_set_state(hass, "light.a", "on", context, brightness=200))
+    _async_set_state(hass, "light.b", "on", context, brightness=200)
+    _async_set_state(hass, "light.c", "on", context, brightness=200)
+    freezer.tick(0.01)
+    await coordinator.async_handle_event(_async_set_state(hass, "light.g", "on", context, brightness=200))
+
+    mock_fan_out.assert_not_awaited()
+
+
+async def test_group_operation_is_fanned_out(
+    hass: HomeAssistant, freezer: FrozenDateTimeFactory, coordinator: LightSyncCoordinator, mock_fan_out: AsyncMock
+) -> None:
+    """直接操作灯组时，灯组以同一个context修改组内灯，灯组的状态变化需要扇出"""
+    context = Context()
+    _async_set_state(hass, "light.b", "on", context, brightness=200)
+    _async_set_state(hass, "light.c", "on", context, brightness=200)
+    freezer.tick(0.01)
+    await coordinator.async_handle_event(_async_set_state(hass, "light.g", "on", context, brightness=200))
+
+    assert [call.args[0] for call in mock_fan_out.await_args_list] == ["light.g"]